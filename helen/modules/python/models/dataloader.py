@@ -1,3 +1,4 @@
+import numpy as np
 from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 import h5py
@@ -60,6 +61,11 @@ class SequenceDataset(Dataset):
             label_base = hdf5_file['images'][image_name]['label_base'][()]
             label_run_length = hdf5_file['images'][image_name]['label_run_length'][()]
 
+        # convert to the datatypes the model and the loss expect here so the dataloader workers do the conversion
+        image = image.astype(np.float32, copy=False)
+        label_base = label_base.astype(np.int64, copy=False)
+        label_run_length = label_run_length.astype(np.int64, copy=False)
+
         return image, label_base, label_run_length
 
     def __len__(self):
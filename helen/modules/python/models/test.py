@@ -1,9 +1,9 @@
 import sys
 import torch
 from tqdm import tqdm
-import torchnet.meter as meter
+import torch.distributed as dist
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import numpy as np
 from helen.modules.python.models.dataloader import SequenceDataset
 from helen.modules.python.TextColor import TextColor
@@ -14,6 +14,21 @@ The test method evaluates a trained model on a given test dataset and report var
 """
 
 
+def add_to_confusion_matrix(confusion_matrix, output, label, num_classes):
+    """
+    Add the predictions of a window to a confusion matrix that lives on the same device as the predictions.
+    :param confusion_matrix: Confusion matrix [num_classes, num_classes], rows are true labels, columns predictions
+    :param output: Output of the model [N, num_classes]
+    :param label: True labels [N]
+    :param num_classes: Number of classes
+    :return:
+    """
+    prediction = output.argmax(dim=1)
+    # accumulate in place, bincount would read the largest index back to the host to size its output
+    confusion_matrix.view(-1).index_put_((label * num_classes + prediction,), torch.ones_like(label),
+                                         accumulate=True)
+
+
 def test(data_filepath,
          batch_size,
          gpu_mode,
@@ -23,7 +38,9 @@ def test(data_filepath,
          hidden_size,
          num_base_classes,
          num_rle_classes,
-         print_details=False):
+         print_details=False,
+         world_size=1,
+         rank=0):
     """
     This method performs testing of a trained model.
     :param data_filepath: Path to a directory containing all labeled h5 files used for testing
@@ -36,10 +53,15 @@ def test(data_filepath,
     :param num_base_classes: Number of classes for base prediction
     :param num_rle_classes: Number of classes for RLE prediction
     :param print_details: A debug parameter.
+    :param world_size: Number of processes testing together, each process tests a shard of the dataset
+    :param rank: Rank of this process, only rank 0 reports the statistics
     :return:
     """
     # data loader
     test_data = SequenceDataset(data_filepath)
+    if world_size > 1:
+        # every process tests every world_size-th image, the shards aren't padded so each image is counted once
+        test_data = Subset(test_data, range(rank, len(test_data), world_size))
     test_loader = DataLoader(test_data,
                              batch_size=batch_size,
                              shuffle=False,
@@ -60,10 +82,12 @@ def test(data_filepath,
         criterion_base = criterion_base.cuda()
         criterion_rle = criterion_rle.cuda()
 
-    # initialize base and rle confusion matrix
-    sys.stderr.write(TextColor.PURPLE + 'Test starting\n' + TextColor.END)
-    base_confusion_matrix = meter.ConfusionMeter(num_base_classes)
-    rle_confusion_matrix = meter.ConfusionMeter(num_rle_classes)
+    # initialize base and rle confusion matrix, they stay on the device the model runs on
+    if rank == 0:
+        sys.stderr.write(TextColor.PURPLE + 'Test starting\n' + TextColor.END)
+    device = torch.device('cuda') if gpu_mode else torch.device('cpu')
+    base_confusion_matrix = torch.zeros(num_base_classes, num_base_classes, dtype=torch.long, device=device)
+    rle_confusion_matrix = torch.zeros(num_rle_classes, num_rle_classes, dtype=torch.long, device=device)
 
     # initialize the accuracy matrices
     total_loss = 0
@@ -72,7 +96,7 @@ def test(data_filepath,
     accuracy = 0
 
     with torch.no_grad():
-        with tqdm(total=len(test_loader), desc='Accuracy: ', leave=True, ncols=100) as pbar:
+        with tqdm(total=len(test_loader), desc='Accuracy: ', leave=True, ncols=100, disable=rank != 0) as pbar:
             # iterate over the dataset in minibatch
             for ii, (images, label_base, label_rle) in enumerate(test_loader):
                 # convert the tensors to a proper datatype
@@ -108,60 +132,61 @@ def test(data_filepath,
                     output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
 
                     # calculate loss between the prediction and the true labels
-                    loss_base = criterion_base(output_base.contiguous().view(-1, num_base_classes),
-                                               label_base_chunk.contiguous().view(-1))
-                    loss_rle = criterion_rle(output_rle.contiguous().view(-1, num_rle_classes),
-                                             label_rle_chunk.contiguous().view(-1))
+                    loss_base = criterion_base(output_base.reshape(-1, num_base_classes),
+                                               label_base_chunk.reshape(-1))
+                    loss_rle = criterion_rle(output_rle.reshape(-1, num_rle_classes),
+                                             label_rle_chunk.reshape(-1))
 
                     loss = loss_base + loss_rle
 
                     # populate the confusion matrix
-                    base_confusion_matrix.add(output_base.data.contiguous().view(-1, num_base_classes),
-                                              label_base_chunk.data.contiguous().view(-1))
-                    rle_confusion_matrix.add(output_rle.data.contiguous().view(-1, num_rle_classes),
-                                             label_rle_chunk.data.contiguous().view(-1))
+                    add_to_confusion_matrix(base_confusion_matrix, output_base.reshape(-1, num_base_classes),
+                                            label_base_chunk.reshape(-1), num_base_classes)
+                    add_to_confusion_matrix(rle_confusion_matrix, output_rle.reshape(-1, num_rle_classes),
+                                            label_rle_chunk.reshape(-1), num_rle_classes)
 
                     total_loss += loss.item()
                     total_images += images.size(0)
                     total_loss_rle += loss_rle.item()
 
                 pbar.update(1)
-                # we calculate the accuracy using the confusion matrix
-                base_cm_value = base_confusion_matrix.value()
-                rle_cm_value = rle_confusion_matrix.value()
-                # the sum of all cells in the confusion matrix is the denominator
-                base_denom = base_cm_value.sum()
-                rle_denom = rle_cm_value.sum()
-
-                # calculate the correct predictions in each case
-                base_corrects = 0
-                for label in range(0, ImageSizeOptions.TOTAL_BASE_LABELS):
-                    base_corrects = base_corrects + base_cm_value[label][label]
-
-                rle_corrects = 0
-                for label in range(0, ImageSizeOptions.TOTAL_RLE_LABELS):
-                    rle_corrects = rle_corrects + rle_cm_value[label][label]
-
-                # calculate the accuracy
-                base_accuracy = 100.0 * (base_corrects / max(1.0, base_denom))
-                rle_accuracy = 100.0 * (rle_corrects / max(1.0, rle_denom))
-
-                # set the tqdm bar's accuracy and loss value
-                pbar.set_description("Base acc: " + str(round(base_accuracy, 4)) +
-                                     ", RLE acc: " + str(round(rle_accuracy, 4)) +
-                                     ", RLE loss: " + str(round(total_loss_rle, 4)))
+                # only rank 0 shows the progress bar, so the other ranks skip reading the accuracy back
+                if rank == 0:
+                    # we calculate the accuracy using the confusion matrix, the correct predictions are on the
+                    # diagonal and the sum of all cells in the confusion matrix is the denominator
+                    base_corrects, base_denom, rle_corrects, rle_denom = \
+                        torch.stack((base_confusion_matrix.trace(), base_confusion_matrix.sum(),
+                                     rle_confusion_matrix.trace(), rle_confusion_matrix.sum())).tolist()
+
+                    # calculate the accuracy
+                    base_accuracy = 100.0 * (base_corrects / max(1.0, base_denom))
+                    rle_accuracy = 100.0 * (rle_corrects / max(1.0, rle_denom))
+
+                    # set the tqdm bar's accuracy and loss value
+                    pbar.set_description("Base acc: " + str(round(base_accuracy, 4)) +
+                                         ", RLE acc: " + str(round(rle_accuracy, 4)) +
+                                         ", RLE loss: " + str(round(total_loss_rle, 4)))
+
+    if world_size > 1:
+        # sum up the statistics of all the shards
+        loss_sum = torch.tensor([total_loss, total_loss_rle, total_images], dtype=torch.float64, device=device)
+        dist.all_reduce(base_confusion_matrix, op=dist.ReduceOp.SUM)
+        dist.all_reduce(rle_confusion_matrix, op=dist.ReduceOp.SUM)
+        dist.all_reduce(loss_sum, op=dist.ReduceOp.SUM)
+        total_loss, total_loss_rle, total_images = loss_sum.tolist()
 
     avg_loss = total_loss / total_images if total_images else 0
-    np.set_printoptions(threshold=np.inf)
-    # print some statistics
-    sys.stderr.write(TextColor.YELLOW+'\nTest Loss: ' + str(avg_loss) + "\n"+TextColor.END)
-    sys.stderr.write(TextColor.BLUE + "Base Confusion Matrix: \n" + str(base_confusion_matrix.value()) + "\n" + TextColor.END)
-    sys.stderr.write(TextColor.RED + "RLE Confusion Matrix: \n" + TextColor.END)
-    for row in rle_confusion_matrix.value():
-        row = row.tolist()
-        for elem in row:
-            sys.stderr.write("{:9d} ".format(elem))
-        sys.stderr.write("\n")
-
-    return {'loss': avg_loss, 'accuracy': accuracy, 'base_confusion_matrix': base_confusion_matrix.conf,
-            'rle_confusion_matrix': rle_confusion_matrix.conf}
+    base_confusion_matrix = base_confusion_matrix.cpu().numpy()
+    rle_confusion_matrix = rle_confusion_matrix.cpu().numpy()
+
+    if rank == 0:
+        # print some statistics
+        sys.stderr.write(TextColor.YELLOW+'\nTest Loss: ' + str(avg_loss) + "\n"+TextColor.END)
+        sys.stderr.write(TextColor.BLUE + "Base Confusion Matrix: \n")
+        np.savetxt(sys.stderr, base_confusion_matrix, fmt='%9d')
+        sys.stderr.write(TextColor.END)
+        sys.stderr.write(TextColor.RED + "RLE Confusion Matrix: \n" + TextColor.END)
+        np.savetxt(sys.stderr, rle_confusion_matrix, fmt='%9d')
+
+    return {'loss': avg_loss, 'accuracy': accuracy, 'base_confusion_matrix': base_confusion_matrix,
+            'rle_confusion_matrix': rle_confusion_matrix}
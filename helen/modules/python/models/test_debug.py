@@ -152,15 +152,15 @@ def test(data_file, batch_size, gpu_mode, transducer_model, num_workers, gru_lay
 
                         column_count += 1
 
-                loss_base = criterion_base(output_base.contiguous().view(-1, num_base_classes),
-                                           label_base_chunk.contiguous().view(-1))
-                loss_rle = criterion_rle(output_rle.contiguous().view(-1, num_rle_classes),
-                                         label_rle_chunk.contiguous().view(-1))
+                loss_base = criterion_base(output_base.reshape(-1, num_base_classes),
+                                           label_base_chunk.reshape(-1))
+                loss_rle = criterion_rle(output_rle.reshape(-1, num_rle_classes),
+                                         label_rle_chunk.reshape(-1))
                 loss = loss_base + loss_rle
-                base_confusion_matrix.add(output_base.data.contiguous().view(-1, num_base_classes),
-                                          label_base_chunk.data.contiguous().view(-1))
-                rle_confusion_matrix.add(output_rle.data.contiguous().view(-1, num_rle_classes),
-                                         label_rle_chunk.data.contiguous().view(-1))
+                base_confusion_matrix.add(output_base.data.reshape(-1, num_base_classes),
+                                          label_base_chunk.data.reshape(-1))
+                rle_confusion_matrix.add(output_rle.data.reshape(-1, num_rle_classes),
+                                         label_rle_chunk.data.reshape(-1))
                 total_loss += loss.item()
                 total_images += images.size(0)
                 total_loss_rle += loss_rle.item()
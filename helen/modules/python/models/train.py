@@ -189,11 +189,11 @@ def train(train_file,
                     output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
 
                     # calculate loss for base prediction
-                    loss_base = criterion_base(output_base.contiguous().view(-1, num_base_classes),
-                                               label_base_chunk.contiguous().view(-1))
+                    loss_base = criterion_base(output_base.reshape(-1, num_base_classes),
+                                               label_base_chunk.reshape(-1))
                     # calculate loss for RLE prediction
-                    loss_rle = criterion_rle(output_rle.contiguous().view(-1, num_rle_classes),
-                                             label_rle_chunk.contiguous().view(-1))
+                    loss_rle = criterion_rle(output_rle.reshape(-1, num_rle_classes),
+                                             label_rle_chunk.reshape(-1))
 
                     # sum the losses to have a singlee optimization over multiple tasks
                     loss = loss_base + loss_rle
@@ -1,9 +1,12 @@
 import sys
 import torch
 import os
+import contextlib
+import numpy as np
 from tqdm import tqdm
 import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.multiprocessing as mp
 
 from torch.utils.data import DataLoader
@@ -24,7 +27,42 @@ Input:
 Return:
 - A trained model
 """
-CLASS_WEIGHTS = [1.0, 1.0, 1.0, 1.0, 1.0]
+
+
+def prefetch_to_device(data_loader, device_id, copy_stream):
+    """
+    Iterate over the batches of a data loader on the device. The next batch is copied to the device on a separate
+    stream while the current batch is being trained on, so the copies overlap with the compute.
+    :param data_loader: Data loader with pinned memory
+    :param device_id: Device to copy the batches to
+    :param copy_stream: CUDA stream used for the copies
+    :return: Batches on the device
+    """
+    def copy_to_device(host_batch):
+        with torch.cuda.stream(copy_stream):
+            device_batch = [tensor.to(device_id, non_blocking=True) for tensor in host_batch]
+            copy_done = torch.cuda.Event()
+            copy_done.record(copy_stream)
+        return device_batch, copy_done
+
+    def wait_for_copy(device_batch, copy_done):
+        # wait only for the copy of this batch, the copy of the next batch keeps running
+        compute_stream = torch.cuda.current_stream(device_id)
+        compute_stream.wait_event(copy_done)
+        # the tensors were allocated on the copy stream, tell the allocator they are used on the compute stream
+        for tensor in device_batch:
+            tensor.record_stream(compute_stream)
+        return device_batch
+
+    batch = None
+    for host_batch in data_loader:
+        next_batch = copy_to_device(host_batch)
+        if batch is not None:
+            yield wait_for_copy(*batch)
+        batch = next_batch
+
+    if batch is not None:
+        yield wait_for_copy(*batch)
 
 
 def save_best_model(transducer_model, model_optimizer, hidden_size, layers, epoch,
@@ -54,17 +92,29 @@ def save_best_model(transducer_model, model_optimizer, hidden_size, layers, epoc
 def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers, retrain_model,
           retrain_model_path, gru_layers, hidden_size, lr, decay, model_dir, stats_dir, train_mode,
           world_size, rank, device_id):
+    # don't call torch.cuda.empty_cache() in the training loop. The caching allocator reuses the freed blocks of a
+    # stream without synchronizing, emptying the cache sends every following allocation back to cudaMalloc, which
+    # synchronizes the device. Reserved memory is kept down by the reused hidden buffer and the bucket-view
+    # gradients of DDP, which are zeroed in place every batch so no second copy of the gradients is allocated.
 
     if train_mode is True and rank == 0:
         train_loss_logger = open(stats_dir + "train_loss.csv", 'w')
         test_loss_logger = open(stats_dir + "test_loss.csv", 'w')
-        confusion_matrix_logger = open(stats_dir + "confusion_matrix.txt", 'w')
     else:
         train_loss_logger = None
         test_loss_logger = None
-        confusion_matrix_logger = None
 
-    torch.cuda.set_device(device_id)
+    if gpu_mode:
+        # the window and batch shapes are fixed, so cudnn can benchmark the GRU kernels once and reuse the fastest.
+        # TF32 lets the matmuls use tensor cores on Ampere and newer GPUs.
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    # run the forward pass in float16 on GPUs with float16 tensor cores (Volta and newer), older GPUs stay in float32.
+    # autocast always runs the cudnn GRUs in float16, so the loss is scaled to keep the gradients from underflowing.
+    use_amp = gpu_mode and torch.cuda.get_device_capability(device_id)[0] >= 7
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     if rank == 0:
         sys.stderr.write(TextColor.PURPLE + 'Loading data\n' + TextColor.END)
@@ -77,13 +127,21 @@ def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers,
         rank=rank
     )
 
+    loader_options = dict()
+    if num_workers > 0:
+        # keep the workers alive between epochs and let them load a few batches ahead of the training loop
+        loader_options['persistent_workers'] = True
+        loader_options['prefetch_factor'] = 4
+
     train_loader = torch.utils.data.DataLoader(
         dataset=train_data_set,
         batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
-        pin_memory=True,
-        sampler=train_sampler)
+        num_workers=num_workers,
+        # batches have a fixed shape, so the caching host allocator hands the same pinned blocks back every batch
+        pin_memory=gpu_mode,
+        sampler=train_sampler,
+        **loader_options)
 
     num_base_classes = ImageSizeOptions.TOTAL_BASE_LABELS
     num_rle_classes = ImageSizeOptions.TOTAL_RLE_LABELS
@@ -127,20 +185,40 @@ def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers,
 
     if gpu_mode:
         transducer_model = transducer_model.to(device_id)
-        transducer_model = nn.parallel.DistributedDataParallel(transducer_model, device_ids=[device_id])
+        # the model has no buffers to keep in sync, so skip the buffer broadcast DDP does before every forward.
+        # the gradients are views into the all-reduce buckets, so DDP doesn't keep a second copy of them.
+        # every parameter gets a gradient in every window, so DDP doesn't need to search the graph for unused ones.
+        transducer_model = nn.parallel.DistributedDataParallel(transducer_model,
+                                                               device_ids=[device_id],
+                                                               output_device=device_id,
+                                                               broadcast_buffers=False,
+                                                               find_unused_parameters=False,
+                                                               gradient_as_bucket_view=True)
+
+    # device where the per-batch tensors of this process live
+    train_device = device_id if gpu_mode else 'cpu'
+
+    # we perform a multi-task classification, so we calculate two cross entropy losses, one for each task.
+    # the RLE loss is weighted by class, the weights are created on the device once.
+    class_weights = torch.as_tensor(TrainOptions.CLASS_WEIGHTS, dtype=torch.float32,
+                                    device=train_device)
 
-    class_weights = torch.Tensor(TrainOptions.CLASS_WEIGHTS)
-    # we perform a multi-task classification, so we need two loss functions, each performing a single task
-    # criterion base is the loss function for base prediction
-    criterion_base = nn.CrossEntropyLoss()
-    # criterion rle is the loss function for RLE prediction
-    criterion_rle = nn.CrossEntropyLoss(weight=class_weights)
+    start_epoch = prev_ite
 
-    if gpu_mode is True:
-        criterion_base = criterion_base.to(device_id)
-        criterion_rle = criterion_rle.to(device_id)
+    # start positions of the training windows that fit inside an image.
+    # the windows are not a memory optimization, they implement truncated backpropagation through time:
+    # consecutive windows overlap by TRAIN_WINDOW - WINDOW_JUMP columns, the hidden output of a window is the
+    # input of the next one and it's detached in between. A single forward over the whole SEQ_LENGTH would
+    # train a different model, so the loop can't be folded into one call.
+    window_starts = list(range(0, ImageSizeOptions.SEQ_LENGTH - TrainOptions.TRAIN_WINDOW + 1,
+                               TrainOptions.WINDOW_JUMP))
 
-    start_epoch = prev_ite
+    # stream for copying the batches to the GPU, so the copies don't queue behind the training kernels
+    copy_stream = torch.cuda.Stream(device_id) if gpu_mode else None
+
+    # the hidden input of the first window is allocated once and zeroed for every batch
+    hidden_buffer = torch.zeros(batch_size, 2 * TrainOptions.GRU_LAYERS, TrainOptions.HIDDEN_SIZE,
+                                device=train_device)
 
     # Train the Model
     if rank == 0:
@@ -152,15 +230,18 @@ def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers,
     stats['accuracy_epoch'] = []
 
     for epoch in range(start_epoch, epoch_limit, 1):
-        total_loss_base = 0
-        total_loss_rle = 0
-        total_loss = 0
+        # the running losses stay on the device so the window loop never waits to read them back
+        total_loss_base = torch.zeros((), device=train_device)
+        total_loss_rle = torch.zeros((), device=train_device)
+        total_loss = torch.zeros((), device=train_device)
         total_images = 0
         if rank == 0:
             sys.stderr.write(TextColor.BLUE + 'Train epoch: ' + str(epoch + 1) + "\n")
         # make sure the model is in train mode. BN is different in train and eval.
 
         batch_no = 1
+        batch_losses = []
+        batch_images = []
         if rank == 0:
             progress_bar = tqdm(
                 total=len(train_loader),
@@ -172,86 +253,104 @@ def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers,
         else:
             progress_bar = None
 
-        transducer_model.train()
-        for images, label_base, label_rle in train_loader:
-            # convert the tensors to the proper datatypes.
-            images = images.type(torch.FloatTensor)
-            label_base = label_base.type(torch.LongTensor)
-            label_rle = label_rle.type(torch.LongTensor)
-
-            hidden = torch.zeros(images.size(0), 2 * TrainOptions.GRU_LAYERS, TrainOptions.HIDDEN_SIZE)
-
-            if gpu_mode:
-                hidden = hidden.to(device_id)
-                images = images.to(device_id)
-                label_base = label_base.to(device_id)
-                label_rle = label_rle.to(device_id)
+        if gpu_mode:
+            # the batches are in pinned memory, so the next batch is copied to the GPU while this one trains
+            train_batches = prefetch_to_device(train_loader, device_id, copy_stream)
+        else:
+            train_batches = train_loader
 
-            for i in range(0, ImageSizeOptions.SEQ_LENGTH, TrainOptions.WINDOW_JUMP):
-                model_optimizer.zero_grad()
+        transducer_model.train()
+        for images, label_base, label_rle in train_batches:
+            # the dataset already returns float images and long labels
+            hidden = hidden_buffer[:images.size(0)].zero_()
 
-                if i + TrainOptions.TRAIN_WINDOW > ImageSizeOptions.SEQ_LENGTH:
-                    break
+            # gradients of all the windows are accumulated and the weights are updated once per batch.
+            # under DDP the gradients are views into the all-reduce buckets, they are zeroed in place so the no_sync
+            # backwards accumulate into the buckets. Setting them to None would make every no_sync backward allocate
+            # a second copy of the gradients. Without DDP, None skips the zeroing kernels.
+            model_optimizer.zero_grad(set_to_none=not gpu_mode)
 
+            for window_no, i in enumerate(window_starts):
                 image_chunk = images[:, i:i+TrainOptions.TRAIN_WINDOW]
                 label_base_chunk = label_base[:, i:i+TrainOptions.TRAIN_WINDOW]
                 label_rle_chunk = label_rle[:, i:i+TrainOptions.TRAIN_WINDOW]
 
-                # get the inference from the model
-                output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
+                # DDP all-reduces the gradients on every backward, so we only let it sync on the last window.
+                # the forward pass has to be inside no_sync as well, otherwise DDP prepares the reducer for it.
+                if gpu_mode and window_no < len(window_starts) - 1:
+                    sync_context = transducer_model.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
+
+                with sync_context:
+                    with torch.cuda.amp.autocast(enabled=use_amp):
+                        # get the inference from the model
+                        output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
 
-                # calculate loss for base prediction
-                loss_base = criterion_base(output_base.contiguous().view(-1, num_base_classes),
-                                           label_base_chunk.contiguous().view(-1))
-                # calculate loss for RLE prediction
-                loss_rle = criterion_rle(output_rle.contiguous().view(-1, num_rle_classes),
-                                         label_rle_chunk.contiguous().view(-1))
+                        # calculate loss for base prediction
+                        loss_base = F.cross_entropy(output_base.reshape(-1, num_base_classes),
+                                                    label_base_chunk.reshape(-1))
+                        # calculate loss for RLE prediction
+                        loss_rle = F.cross_entropy(output_rle.reshape(-1, num_rle_classes),
+                                                   label_rle_chunk.reshape(-1),
+                                                   weight=class_weights)
 
-                # sum the losses to have a singlee optimization over multiple tasks
-                loss = loss_base + loss_rle
+                        # sum the losses to have a singlee optimization over multiple tasks
+                        loss = loss_base + loss_rle
 
-                # backpropagation and weight update
-                loss.backward()
-                model_optimizer.step()
+                    # backpropagation, the gradients are accumulated over the windows
+                    grad_scaler.scale(loss).backward()
 
                 # update the loss values
-                total_loss += loss.item()
-                total_loss_base += loss_base.item()
-                total_loss_rle += loss_rle.item()
+                total_loss += loss.detach()
+                total_loss_base += loss_base.detach()
+                total_loss_rle += loss_rle.detach()
                 total_images += image_chunk.size(0)
 
-                # detach the hidden from the graph as the next chunk will be a new optimization
+                # detach the hidden from the graph as the next chunk is backpropagated on its own
                 hidden = hidden.detach()
 
-            # update the progress bar
-            avg_loss = (total_loss / total_images) if total_images else 0
-
-            if train_mode is True and rank == 0:
-                train_loss_logger.write(str(epoch + 1) + "," + str(batch_no) + "," + str(avg_loss) + "\n")
+            # weight update with the gradients accumulated over all the windows
+            grad_scaler.step(model_optimizer)
+            grad_scaler.update()
 
             if rank == 0:
-                avg_loss = (total_loss / total_images) if total_images else 0
-                progress_bar.set_description("Base: " + str(round(total_loss_base, 4)) +
-                                             ", RLE: " + str(round(total_loss_rle, 4)) +
-                                             ", TOTAL: " + str(round(total_loss, 4)))
-                progress_bar.refresh()
+                if train_mode is True:
+                    # keep a copy of the running loss on the device, the rows are written once the epoch is done
+                    batch_losses.append(total_loss.clone())
+                    batch_images.append(total_images)
+
+                # update the progress bar, the losses are read back from the device only when the bar is updated
+                if batch_no % 16 == 0 or batch_no == len(train_loader):
+                    epoch_loss, epoch_loss_base, epoch_loss_rle = \
+                        torch.stack((total_loss, total_loss_base, total_loss_rle)).tolist()
+                    progress_bar.set_description("Base: " + str(round(epoch_loss_base, 4)) +
+                                                 ", RLE: " + str(round(epoch_loss_rle, 4)) +
+                                                 ", TOTAL: " + str(round(epoch_loss, 4)))
                 progress_bar.update(1)
                 batch_no += 1
 
         if rank == 0:
             progress_bar.close()
-        dist.barrier()
 
-        if rank == 0:
-            stats_dictionary = test(test_file, batch_size, gpu_mode, transducer_model, num_workers,
-                                    gru_layers, hidden_size, num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
-                                    num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS)
-            stats['loss'] = stats_dictionary['loss']
-            stats['accuracy'] = stats_dictionary['accuracy']
-            stats['loss_epoch'].append((epoch, stats_dictionary['loss']))
-            stats['accuracy_epoch'].append((epoch, stats_dictionary['accuracy']))
+        if train_mode is True and rank == 0 and batch_losses:
+            train_loss_rows = []
+            for i, (batch_loss, images_seen) in enumerate(zip(torch.stack(batch_losses).tolist(), batch_images)):
+                avg_loss = (batch_loss / images_seen) if images_seen else 0
+                train_loss_rows.append(str(epoch + 1) + "," + str(i + 1) + "," + str(avg_loss) + "\n")
+            train_loss_logger.writelines(train_loss_rows)
+
         dist.barrier()
 
+        # every process tests a shard of the test set, so no process sits idle while the model is evaluated
+        stats_dictionary = test(test_file, batch_size, gpu_mode, transducer_model, num_workers,
+                                gru_layers, hidden_size, num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
+                                num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS, world_size=world_size, rank=rank)
+        stats['loss'] = stats_dictionary['loss']
+        stats['accuracy'] = stats_dictionary['accuracy']
+        stats['loss_epoch'].append((epoch, stats_dictionary['loss']))
+        stats['accuracy_epoch'].append((epoch, stats_dictionary['accuracy']))
+
         # update the loggers
         if train_mode is True and rank == 0:
             ModelHandler.save_model(transducer_model, model_optimizer,
@@ -260,10 +359,11 @@ def train(train_file, test_file, batch_size, epoch_limit, gpu_mode, num_workers,
             sys.stderr.write(TextColor.RED + "\nMODEL SAVED SUCCESSFULLY.\n" + TextColor.END)
 
             test_loss_logger.write(str(epoch + 1) + "," + str(stats['loss']) + "," + str(stats['accuracy']) + "\n")
-            confusion_matrix_logger.write(str(epoch + 1) + "\n" + str(stats_dictionary['base_confusion_matrix']) + "\n")
+            # save the confusion matrix as it is instead of formatting it to text
+            np.save(stats_dir + "base_confusion_matrix_epoch_" + str(epoch + 1) + ".npy",
+                    stats_dictionary['base_confusion_matrix'])
             train_loss_logger.flush()
             test_loss_logger.flush()
-            confusion_matrix_logger.flush()
         elif train_mode is False:
             # this setup is for hyperband
             if epoch + 1 >= 10 and stats['accuracy'] < 98:
@@ -284,13 +384,18 @@ def setup(rank, device_ids, args):
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = '12355'
 
-    # initialize the process group
-    dist.init_process_group("gloo", rank=rank, world_size=len(device_ids))
-
     train_file, test_file, batch_size, epochs, gpu_mode, num_workers, retrain_model, \
     retrain_model_path, gru_layers, hidden_size, learning_rate, weight_decay, model_dir, stats_dir, total_callers, \
     train_mode = args
 
+    # initialize the process group, NCCL does the gradient all-reduce GPU to GPU without staging through the host.
+    # the device has to be set before NCCL initializes so each process binds to its own GPU.
+    if gpu_mode:
+        torch.cuda.set_device(device_ids[rank])
+        dist.init_process_group("nccl", rank=rank, world_size=len(device_ids))
+    else:
+        dist.init_process_group("gloo", rank=rank, world_size=len(device_ids))
+
     # issue with semaphore lock: https://github.com/pytorch/pytorch/issues/2517
     # mp.set_start_method('spawn')
 